@@ -0,0 +1,101 @@
+"""Thin client for a code_analyzer server started with `code_analyzer.py --serve`.
+
+Nothing but os, sys and the _socket extension is imported, so an editor or a pre-commit hook pays
+the interpreter startup and one round-trip instead of loading the analyzer and a cold scan:
+
+    python code_analyzer.py --serve &
+    python -S analyzer_client.py pkg other.py
+    python -S analyzer_client.py --stdin-name pkg/mod.py < unsaved_buffer.py
+
+Editors that keep a process of their own can skip this script and speak the protocol directly:
+one JSON request line, answered by the report, after which the server closes the connection.
+"""
+import _socket
+import os
+import sys
+
+# json and socket pull in re and enum, which cost more than the round-trip itself
+escapes = {code: f"\\u{code:04x}" for code in range(32)}
+escapes.update({ord('"'): '\\"', ord("\\"): "\\\\"})
+
+
+def default_socket() -> str:
+    """$XDG_RUNTIME_DIR/code_analyzer.sock, or a socket in a private per-user directory below $TMPDIR,
+    which the server creates with mode 0700"""
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "code_analyzer.sock")
+    return os.path.join(os.environ.get("TMPDIR", "/tmp"), f"code_analyzer-{os.getuid()}", "server.sock")
+
+
+def dumps(value) -> str:
+    """JSON text of the request: dicts, lists, strings and booleans are all it ever contains"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        return '"' + value.translate(escapes) + '"'
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{dumps(key)}:{dumps(item)}" for key, item in value.items()) + "}"
+    return "[" + ",".join(map(dumps, value)) + "]"
+
+
+def send(request, socket_path=None, stream=None):
+    """Sends one request and copies the report to stream, a binary file (stdout by default)"""
+    stream = sys.stdout.buffer if stream is None else stream
+    client = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path or default_socket())
+        client.sendall(dumps(request).encode() + b"\n")
+        client.shutdown(_socket.SHUT_WR)
+        while True:
+            chunk = client.recv(1 << 16)
+            if not chunk:
+                break
+            stream.write(chunk)
+    finally:
+        client.close()
+    stream.flush()
+
+
+def main(argv=None):
+    # argparse alone costs more than the whole round-trip, so the few options are parsed by hand
+    argv = sys.argv[1:] if argv is None else argv
+    request = {"cwd": os.getcwd(), "paths": []}
+    socket_path = None
+    options = ("--socket", "--select", "--ignore", "--format", "--stdin-name")
+    position = 0
+    while position < len(argv):
+        arg = argv[position]
+        if arg == "--shutdown":
+            request["shutdown"] = True
+            position += 1
+            continue
+        if arg in ("-h", "--help"):
+            print(f"usage: analyzer_client.py [--socket PATH] [--select CODES] [--ignore CODES] "
+                  f"[--format FORMAT] [--stdin-name NAME] [--shutdown] [paths ...]\n{__doc__}")
+            return 0
+        if arg in options:
+            if position + 1 == len(argv):
+                print(f"analyzer_client.py: {arg} expects a value", file=sys.stderr)
+                return 2
+            value = argv[position + 1]
+            position += 2
+            if arg == "--socket":
+                socket_path = value
+            elif arg == "--stdin-name":
+                request["buffers"] = [{"path": value, "source": sys.stdin.read()}]
+            else:
+                request[arg[2:]] = value
+            continue
+        request["paths"].append(arg)
+        position += 1
+    try:
+        send(request, socket_path)
+    except OSError as error:
+        print(f"cannot reach the analysis server at {socket_path or default_socket()}: {error}", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""Reproducible benchmark for code_analyzer.
+
+Generates a synthetic corpus (or uses an existing directory), warms up, then times every file
+repeatedly with time.perf_counter, per stage (read, parse, check_lines, check_tokens, check_ast) and
+per rule. Median and p95 of every metric go to a JSON file so that runs of two versions can be compared:
+
+    python benchmark.py --files 200 --repeat 7 -o bench_output.json
+"""
+from time import perf_counter
+import argparse
+import collections
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+
+from code_analyzer import CodeAnalyzer, FileFinder, ProfiledAnalyzer
+
+
+class CorpusGenerator(object):
+    """Deterministic synthetic python files mixing clean code, rule violations, long lines and deep nesting"""
+    sizes = (20, 200, 2000, 10000)  # lines per file, picked with the weights below
+    size_weights = (50, 30, 15, 5)
+    densities = (0.0, 0.05, 0.3)  # share of emitted statements that break a rule
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+
+    def name(self, snake=True) -> str:
+        words = self.random.choice(("data", "result", "value", "item", "node", "index", "buffer", "count"))
+        words += "_" + self.random.choice(("list", "map", "total", "next", "cache", "state"))
+        if snake:
+            return words
+        return "".join(part.title() for part in words.split("_"))
+
+    def statement(self, indent, density) -> list:
+        pad = " " * indent
+        bad = self.random.random() < density
+        kind = self.random.randrange(8)
+        if kind == 0:
+            return [f"{pad}{self.name(not bad)} = {self.random.randrange(1000)}{';' if bad else ''}"]
+        if kind == 1:
+            comment = "# TODO: revisit" if bad else "# explain"
+            return [f"{pad}value = 1{' ' if bad else '  '}{comment}"]
+        if kind == 2:
+            # long lines, up to several hundred characters
+            length = self.random.choice((60, 120, 500)) if bad else 60
+            return [f"{pad}text = \"{'x' * length}\""]
+        if kind == 3:
+            # misaligned comments keep the file parseable while breaking S002
+            return [f"{pad}{' ' if bad else ''}# note"]
+        if kind == 4:
+            return [f"{pad}text = \"a # not a comment; {'TODO' if bad else 'done'}\""]
+        if kind == 5:
+            return [f"{pad}{self.name()}, ({self.name(not bad)}, *rest) = 1, (2, 3, 4)"]
+        if kind == 6 and bad:
+            return ["", "", "", f"{pad}pass"]
+        return [f"{pad}pass"]
+
+    def function(self, indent, density, depth) -> list:
+        pad = " " * indent
+        bad = self.random.random() < density
+        name = self.name(not bad)
+        args = f"{self.name()}, {self.name(not bad)}={'[]' if bad else 'None'}, *, key=dict()"
+        lines = [f"{pad}{'async ' if self.random.random() < 0.1 else ''}def {name}({args}):"]
+        indent += 4
+        for level in range(depth):
+            lines.append(f"{' ' * indent}if {self.name()} > {level}:")
+            indent += 4
+            for _ in range(self.random.randrange(1, 4)):
+                lines.extend(self.statement(indent, density))
+        lines.append(f"{' ' * indent}return None")
+        return lines
+
+    def module(self, size, density) -> str:
+        lines = ["import os", "import sys", "", ""]
+        while len(lines) < size:
+            choice = self.random.random()
+            if choice < 0.2:
+                bad = self.random.random() < density
+                lines.append(f"class {'lower_' + self.name() if bad else self.name(False)}:")
+                lines.extend(self.function(4, density, self.random.randrange(4)))
+            elif choice < 0.5:
+                lines.extend(self.function(0, density, self.random.choice((1, 3, 12))))
+            else:
+                lines.extend(self.statement(0, density))
+            lines.extend(("", ""))
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory, files) -> dict:
+        summary = {"files": files, "lines": 0, "bytes": 0}
+        for number in range(files):
+            size = self.random.choices(CorpusGenerator.sizes, CorpusGenerator.size_weights)[0]
+            density = self.random.choice(CorpusGenerator.densities)
+            source = self.module(size, density)
+            package = os.path.join(directory, f"package_{number % 10}")
+            os.makedirs(package, exist_ok=True)
+            with open(os.path.join(package, f"module_{number}.py"), "w") as f:
+                f.write(source)
+            summary["lines"] += source.count("\n")
+            summary["bytes"] += len(source)
+        return summary
+
+
+def run_once(files, rule_timing=False) -> dict:
+    """Seconds per stage, or per rule with rule_timing, summed over all files.
+
+    Timing every rule call inflates the stage timings, so the two are taken in separate runs."""
+    timings = collections.defaultdict(float)
+    start = perf_counter()
+    for file in files:
+        analyzer = ProfiledAnalyzer(file, rule_timing=rule_timing)
+        analyzer.pep_checks_wrapper()
+        for name, seconds in analyzer.times.items():
+            timings[name] += seconds
+    timings["total"] = perf_counter() - start
+    return timings
+
+
+def percentile(values, share) -> float:
+    """Nearest-rank percentile, exact for the small sample counts used here"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+def summarise(samples) -> dict:
+    names = sorted({name for sample in samples for name in sample})
+    return {name: {"median": statistics.median([sample.get(name, 0.0) for sample in samples]),
+                   "p95": percentile([sample.get(name, 0.0) for sample in samples], 0.95)}
+            for name in names}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark code_analyzer on a synthetic or existing corpus")
+    parser.add_argument("--corpus", help="directory to analyse instead of a generated corpus")
+    parser.add_argument("--files", type=int, default=200, help="number of generated files")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus generator")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs before measuring")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per measurement")
+    parser.add_argument("-o", "--output", default="bench_output.json", help="machine readable results")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.corpus:
+            corpus = {"path": args.corpus}
+            files = list(FileFinder(args.corpus).files())
+        else:
+            corpus = CorpusGenerator(args.seed).write(directory, args.files)
+            corpus["seed"] = args.seed
+            files = list(FileFinder(directory).files())
+        lines = 0
+        for file in files:
+            with open(file, "rb") as f:
+                lines += f.read().count(b"\n")
+        corpus.update(files=len(files), lines=lines)
+
+        for _ in range(args.warmup):
+            run_once(files)
+        stages = summarise([run_once(files) for _ in range(args.repeat)])
+        runs = [run_once(files, rule_timing=True) for _ in range(args.repeat)]
+        rules = summarise([{name: seconds for name, seconds in run.items() if name.startswith("S")} for run in runs])
+
+    total = stages["total"]["median"]
+    results = {
+        "analyzer_version": CodeAnalyzer.version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+        "corpus": corpus,
+        "throughput": {"files_per_second": len(files) / total, "lines_per_second": lines / total},
+        "stages": stages,
+        "rules": rules,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{len(files)} files, {lines} lines: {results['throughput']['lines_per_second']:.0f} lines/s")
+    for section in ("stages", "rules"):
+        for name, value in results[section].items():
+            print(f"{name:>12}  median {value['median'] * 1000:9.2f} ms  p95 {value['p95'] * 1000:9.2f} ms")
+    print(f"results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
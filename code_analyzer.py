@@ -1,21 +1,83 @@
-from re import search
+from time import perf_counter
+import argparse
+import array
+import base64
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import linecache
+import mmap
 import os.path
+import subprocess
 import sys
+import tempfile
 import time
 import re
+import socket
+import socketserver
+import stat
+import string
+import tokenize
 
 import ast
 
+import analyzer_client
+
 
 class Analyzer(ast.NodeVisitor):
     def __init__(self):
         self.stats = {"import": [], "from": [], "class": []}
         self.imports = []
+        self.imports_from = []  # (module, level, names) of every "from module import names"
+        self.assignments = []  # (line, column, name) of every name bound by an assignment
+        self.functions = []  # FunctionDef and AsyncFunctionDef nodes
+        self.classes = []  # ClassDef nodes
 
     def visit_ClassDef(self, node):
-        print()
-        for alias in node.names:
-            self.stats["class"].append(alias.name)
+        self.stats["class"].append(node.name)
+        self.classes.append(node)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        self.functions.append(node)
+        self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def add_target(self, target):
+        """Collects plain names from an assignment target, unpacking tuples, lists and starred names"""
+        if isinstance(target, ast.Name):
+            self.assignments.append((target.lineno, target.col_offset, target.id))
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for element in target.elts:
+                self.add_target(element)
+        elif isinstance(target, ast.Starred):
+            self.add_target(target.value)
+
+    def visit_Assign(self, node):
+        for target in node.targets:
+            self.add_target(target)
+        self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        self.add_target(node.target)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        self.add_target(node.target)
+        self.generic_visit(node)
+
+    def visit_NamedExpr(self, node):
+        self.add_target(node.target)
+        self.generic_visit(node)
 
     def visit_Import(self, node):
         for alias in node.names:
@@ -26,6 +88,7 @@ class Analyzer(ast.NodeVisitor):
     def visit_ImportFrom(self, node):
         for alias in node.names:
             self.stats["from"].append(alias.name)
+        self.imports_from.append((node.module or "", node.level, [alias.name for alias in node.names]))
         self.generic_visit(node)
 
     def report(self):
@@ -35,97 +98,358 @@ class Analyzer(ast.NodeVisitor):
         return self.imports
 
 
+class LineInfo(object):
+    """Facts about one source line, computed once and shared by every line rule"""
+    __slots__ = ("number", "text", "stripped", "indent", "blank")
+
+    def __init__(self, number, text):
+        self.number = number
+        self.text = text
+        self.stripped = text.strip()
+        self.indent = len(text) - len(text.lstrip(" "))
+        self.blank = not self.stripped
+
+
+class Rule(object):
+    """One check: its code, its message, the CodeAnalyzer method implementing it and the stage feeding it.
+
+    "lines" rules get a LineInfo per line, "tokens" rules get COMMENT and NEWLINE tokens and
+    "ast" rules get the Analyzer that walked the module tree."""
+    __slots__ = ("code", "message", "stage", "method")
+
+    def __init__(self, code, message, stage, method):
+        self.code = code
+        self.message = message
+        self.stage = stage
+        self.method = method
+
+    @staticmethod
+    def parse_code(name) -> int:
+        """Converts a rule name such as "S003" to its code"""
+        if name[:1].upper() != "S" or not name[1:].isdigit() or int(name[1:]) not in CodeAnalyzer.registry:
+            raise ValueError(f"unknown rule: {name}")
+        return int(name[1:])
+
+
+class Diagnostics(object):
+    """Findings of one file, each packed into a single 64-bit integer: line << 32 | code << 24 | column.
+
+    Integer order is (line, code, column) order, so sorting needs no key function. Rules append
+    findings in line order, stage after stage, so sort() usually only merges a few ascending runs;
+    past max_runs (e.g. line and token rules interleaved by check_stream) it falls back to sorted().
+    The packed array pickles and caches as one bytes object instead of one object per finding."""
+    __slots__ = ("keys", "runs")
+    max_runs = 64
+
+    def __init__(self, packed=b""):
+        """packed is the output of tobytes(), which is always sorted"""
+        self.keys = array.array("Q")
+        self.keys.frombytes(packed)
+        self.runs = [0]  # start index of every ascending run in keys, None once there are too many
+
+    @staticmethod
+    def unpack(key) -> tuple:
+        return key >> 32, key >> 24 & 0xFF, key & 0xFFFFFF
+
+    def add(self, line, code, column=0):
+        key = line << 32 | code << 24 | min(column, 0xFFFFFF)
+        if self.runs is not None and self.keys and key < self.keys[-1]:
+            self.runs.append(len(self.keys))
+            if len(self.runs) > Diagnostics.max_runs:
+                self.runs = None
+        self.keys.append(key)
+
+    def sort(self):
+        if self.runs is None:
+            self.keys = array.array("Q", sorted(self.keys))
+            self.runs = [0]
+        elif len(self.runs) > 1:
+            bounds = self.runs + [len(self.keys)]
+            runs = [self.keys[start:end] for start, end in zip(bounds, bounds[1:])]
+            self.keys = array.array("Q", heapq.merge(*runs))
+            self.runs = [0]
+
+    def tobytes(self) -> bytes:
+        self.sort()
+        return self.keys.tobytes()
+
+    def __reduce__(self):
+        return Diagnostics, (self.tobytes(),)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        """(line, code, column) for every finding; column is 1-based, 0 when the rule has none"""
+        return map(Diagnostics.unpack, self.keys)
+
+
+@contextlib.contextmanager
+def open_buffer(file):
+    """Yields the whole content of file from a single binary read, memory mapped for large files"""
+    with open(file, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= CodeAnalyzer.mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+        else:
+            yield f.read()
+
+
 class CodeAnalyzer(object):
-    error_codes = {1: "S001 Too long",
-                   2: "S002 Indentation is not a multiple of four",
-                   3: "S003 Unnecessary semicolon",
-                   4: "S004 At least two spaces required before inline comments",
-                   5: "S005 TODO found",
-                   6: "S006 More than two blank lines used before this line",
-                   7: "S007 Too many spaces after construction_name (def or class)",
-                   8: "S008 Class name class_name should be written in CamelCase",
-                   9: "S009 Function name function_name should be written in snake_case",
-                   10: "S010 Argument name arg_name should be written in snake_case",
-                   11: "S011 Variable var_name should be written in snake_case",
-                   12: "S012 The default argument value is mutable"}
-    template_camel = r"(^[A-Z][a-z0-9]+)([A-Z][a-z0-9]+)*\s*(\(.*\))?:?$"
-    template_snake = r"(^[_a-z0-9]+)(_[a-z0-9]+)*\s*(\(.*\))?:?$"
-
-    def __init__(self, file):
+    registry = {rule.code: rule for rule in (
+        Rule(1, "S001 Too long", "lines", "line_length"),
+        Rule(2, "S002 Indentation is not a multiple of four", "lines", "line_indent"),
+        Rule(3, "S003 Unnecessary semicolon", "tokens", "token_semicolon"),
+        Rule(4, "S004 At least two spaces required before inline comments", "tokens", "token_inline_comment"),
+        Rule(5, "S005 TODO found", "tokens", "token_todo"),
+        Rule(6, "S006 More than two blank lines used before this line", "lines", "line_new_lines"),
+        Rule(7, "S007 Too many spaces after construction_name (def or class)", "lines", "line_spacing_after_name"),
+        Rule(8, "S008 Class name class_name should be written in CamelCase", "ast", "ast_class_name"),
+        Rule(9, "S009 Function name function_name should be written in snake_case", "ast", "ast_function_name"),
+        Rule(10, "S010 Argument name arg_name should be written in snake_case", "ast", "ast_argument_names"),
+        Rule(11, "S011 Variable var_name should be written in snake_case", "ast", "ast_variable_names"),
+        Rule(12, "S012 The default argument value is mutable", "ast", "ast_mutable_defaults"),
+    )}
+    error_codes = {code: rule.message for code, rule in registry.items()}
+    snake_chars = string.ascii_lowercase + string.digits + "_"
+    camel_tail_chars = string.ascii_lowercase + string.digits
+    mmap_threshold = 1024 * 1024  # files at least this large are memory mapped instead of read
+    max_ast_size = 64 * 1024 * 1024  # larger files only get the line and token rules, streamed
+    version = "1.3"  # part of the result cache key, bump whenever a check changes its output
+    # tokenize is pure python before 3.12, a regular expression scan is much cheaper there, see check_tokens()
+    scan_markers = sys.version_info < (3, 12)
+    # a comment, a semicolon or a whole string literal, which hides any # or ; inside it
+    marker_pattern = re.compile("|".join((
+        r"#[^\n]*",
+        r";",
+        r'"{3}[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*(?:"{3}|\Z)',
+        r"'{3}[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*(?:'{3}|\Z)",
+        r'"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"?',
+        r"'[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*'?",
+    )))
+    common_identifiers = ("self", "cls", "args", "kwargs", "data", "result", "value", "key", "name", "path",
+                          "node", "item", "index", "line", "text", "error", "other", "obj", "func",
+                          "main", "run", "get", "set", "update", "setUp", "tearDown", "__init__", "__str__")
+    mutable_calls = ("list", "dict", "set", "bytearray", "defaultdict", "OrderedDict", "Counter", "deque")
+
+    def __init__(self, file, rules=None, source=None):
+        """rules is a collection of enabled rule codes, all of them by default.
+        Stages no enabled rule needs are skipped, e.g. the file is not parsed without an "ast" rule,
+        except to validate it for check_markers() where that beats the tokenizer.
+        source is the raw content of file (bytes or a buffer) when the caller has already read it.
+        Files larger than max_ast_size are not loaded at all but streamed by check_stream()."""
         self.file = file
+        self.enabled = set(CodeAnalyzer.registry if rules is None else rules)
+        self.stages = {CodeAnalyzer.registry[code].stage for code in self.enabled}
+        self.tree = None
+        self.file_lines = []
+        self.source = None
+        self.streaming = False
+        self.streamed_lines = 0  # set by check_stream(), which never builds file_lines
+        self.errors = Diagnostics()
         try:
-            with open(self.file) as f:
-                self.file_lines = f.readlines()
-            with open(self.file) as f:
-                try:
-                    self.tree = ast.parse(f.read())
-                except SyntaxError:
-                    self.tree = []
-                    print("error")
+            size = os.path.getsize(self.file) if source is None else len(source)
+            if size > CodeAnalyzer.max_ast_size:
+                self.streaming = True
+                self.source = source if isinstance(source, bytes) else None
+                skipped = [CodeAnalyzer.registry[code].message[:4] for code in sorted(self.enabled)
+                           if CodeAnalyzer.registry[code].stage == "ast"]
+                if skipped:
+                    print(f"{self.file}: {size} bytes is over the {CodeAnalyzer.max_ast_size} bytes AST limit, "
+                          f"{', '.join(skipped)} skipped", file=sys.stderr)
+            elif source is not None:
+                self.load(source)
+            else:
+                with open_buffer(self.file) as buffer:
+                    self.load(buffer)
         except FileNotFoundError:
-            print("Path Does not exist")
-            self.file_lines = []
-        self.errors = []
+            print(f"{self.file}: Path Does not exist", file=sys.stderr)
+        self.analyzer = None
+
+    def decode(self, buffer) -> str:
+        """Decodes the raw file once, using its PEP 263 coding cookie or BOM and utf-8 otherwise"""
+        if isinstance(buffer, mmap.mmap):
+            readline = buffer.readline
+        else:
+            readline = io.BytesIO(buffer).readline
+        try:
+            encoding = tokenize.detect_encoding(readline)[0]
+        except SyntaxError as error:
+            print(f"{self.file}: {error}", file=sys.stderr)
+            encoding = "utf-8"
+        try:
+            return str(buffer, encoding)
+        except (UnicodeDecodeError, LookupError) as error:
+            print(f"{self.file}: {error}", file=sys.stderr)
+            return str(buffer, "utf-8", "replace")
+
+    def load(self, buffer):
+        """Builds the line list and, if needed, the AST from one decoded copy of the file.
+
+        Token rules alone need the AST too where scan_markers is set: parsing is several times
+        cheaper than tokenize, and only a file that parsed can take check_markers() instead."""
+        text = self.decode(buffer)
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        self.file_lines = io.StringIO(text).readlines()
+        if "ast" in self.stages or ("tokens" in self.stages and CodeAnalyzer.scan_markers
+                                    and ("#" in text or ";" in text)):
+            self.parse(text)
+
+    def parse(self, text):
+        try:
+            self.tree = ast.parse(text)
+        except SyntaxError as error:
+            print(f"{self.file}: {error}", file=sys.stderr)
 
     @staticmethod
     def sub_quotes(source) -> list:
         return re.findall('"([^"]*)"', source)
 
-    def error_add(self, line, error_code):
+    def error_add(self, line, error_code, column=0):
         """Adds error code, line is number of line where is the error occurred, error code is self explanatory"""
-        self.errors.append([line, error_code])  # line and code
-
-    def check_lines_length(self):
-        for counter, line in enumerate(self.file_lines):
-            if len(line) > 79:
-                self.error_add(counter + 1, 1)
-
-    def check_indent(self):
-        for counter, line in enumerate(self.file_lines):
-            if line.startswith(" "):
-                indent_len = len(line) - len(line.lstrip(" "))
-                if indent_len % 4 != 0:
-                    self.error_add(counter + 1, 2)
-
-    def check_semicolon(self):
-        for counter, line in enumerate(self.file_lines):
-            data = line.split("#")[0].rstrip()
-            try:
-                if data[-1] == ";":
-                    self.error_add(counter + 1, 3)
-            except IndexError:
-                pass
+        self.errors.add(line, error_code, column)
 
-    def check_inline_comment(self):
-        for counter, line in enumerate(self.file_lines):
-            data = line.split("#")
-            try:
-                if data[1]:
-                    indent_len = len(data[0]) - len(data[0].rstrip(" "))
-                    if indent_len < 2 and len(data[0]) > 1:
-                        self.error_add(counter + 1, 4)
-            except IndexError:
-                pass
+    def line_length(self, line):
+        if len(line.text) > 79:
+            self.error_add(line.number, 1, 80)
 
-    def check_todo(self):
-        for counter, line in enumerate(self.file_lines):
-            if "#" in line and "todo" in line.lower():
-                if line.index("#") < line.lower().index("todo"):
-                    self.error_add(counter + 1, 5)
-
-    def check_new_lines(self):
-        blank_lines_count = 0
-        for counter, line in enumerate(self.file_lines):
-            if line == "\n":
-                blank_lines_count += 1
-                continue
-            if line != "\n" and blank_lines_count < 3:
-                blank_lines_count = 0
-                continue
-            if line != "\n" and blank_lines_count > 2:
-                self.error_add(counter + 1, 6)
-                blank_lines_count = 0
+    def line_indent(self, line):
+        if line.indent % 4 != 0:
+            self.error_add(line.number, 2, 1)
+
+    def line_new_lines(self, line):
+        if line.blank:
+            self.blank_lines_count += 1
+            return
+        if self.blank_lines_count > 2:
+            self.error_add(line.number, 6, 1)
+        self.blank_lines_count = 0
+
+    def line_spacing_after_name(self, line):
+        if line.stripped.startswith("class") or line.stripped.startswith("def"):
+            start_index = line.stripped.find(" ")
+            if start_index != -1:
+                outline = line.stripped[start_index:]
+                if len(outline) - len(outline.lstrip()) > 1:
+                    self.error_add(line.number, 7, line.indent + start_index + 2)
+
+    def stage_rules(self, stage) -> list:
+        """Bound methods of the enabled rules of one stage, in code order"""
+        return [getattr(self, rule.method) for code, rule in sorted(CodeAnalyzer.registry.items())
+                if rule.stage == stage and code in self.enabled]
+
+    def check_lines(self):
+        """Single pass over the file feeding every line rule with shared per-line facts"""
+        rules = self.stage_rules("lines")
+        self.blank_lines_count = 0
+        for number, text in enumerate(self.file_lines, 1):
+            line = LineInfo(number, text)
+            for rule in rules:
+                rule(line)
+
+    def token_semicolon(self, token):
+        if token.type == tokenize.NEWLINE and self.last_token is not None and self.last_token.string == ";":
+            self.error_add(self.last_token.start[0], 3, self.last_token.start[1] + 1)
+
+    def token_inline_comment(self, token):
+        if token.type == tokenize.COMMENT:
+            before = token.line[:token.start[1]]
+            if before.strip() and len(before) - len(before.rstrip(" ")) < 2:
+                self.error_add(token.start[0], 4, token.start[1] + 1)
+
+    def token_todo(self, token):
+        if token.type == tokenize.COMMENT and "todo" in token.string.lower():
+            self.error_add(token.start[0], 5, token.start[1] + 1)
+
+    def check_tokens(self, readline=None):
+        """Single tokenizer pass feeding COMMENT and NEWLINE tokens to the token rules (S003-S005).
+        readline defaults to reading the loaded file lines.
+
+        The pure python tokenizer is the costliest stage, so a file that parsed is scanned by
+        check_markers() instead, and one without any # or ; is not tokenized at all."""
+        rules = self.stage_rules("tokens")
+        if readline is None:
+            if not any("#" in text or ";" in text for text in self.file_lines):
+                return
+            if self.tree is not None and CodeAnalyzer.scan_markers:
+                self.check_markers(rules)
+                return
+        self.last_token = None  # last OP/NAME/... token, comments and blank lines excluded
+        if readline is None:
+            readline = iter(self.file_lines).__next__
+        try:
+            for token in tokenize.generate_tokens(readline):
+                if token.type in (tokenize.COMMENT, tokenize.NEWLINE):
+                    for rule in rules:
+                        rule(token)
+                elif token.type not in (tokenize.NL, tokenize.INDENT, tokenize.DEDENT):
+                    self.last_token = token
+        except (tokenize.TokenError, SyntaxError):
+            pass
+
+    def check_markers(self, rules):
+        """Feeds the token rules the COMMENT tokens, and a NEWLINE token after each trailing semicolon,
+        that tokenize would produce, found with one marker_pattern scan over the file.
+
+        This is only exact for a file that parsed: there every # or ; outside a string literal is a
+        comment or a statement separator, and a semicolon ends its logical line when nothing but
+        blanks and a comment follow it on its physical line."""
+        text = "".join(self.file_lines)
+        starts = list(itertools.accumulate(map(len, self.file_lines), initial=0))
+        self.last_token = None
+        for match in CodeAnalyzer.marker_pattern.finditer(text):
+            marker = match.group()
+            if marker[0] in "\"'":
                 continue
+            number = bisect.bisect_right(starts, match.start())
+            line = self.file_lines[number - 1]
+            column = match.start() - starts[number - 1]
+            if marker == ";":
+                rest = line[column + 1:].lstrip(" \t\f")
+                if rest and rest[0] not in "#\n":
+                    continue
+                self.last_token = tokenize.TokenInfo(tokenize.OP, ";", (number, column), (number, column + 1), line)
+                token = tokenize.TokenInfo(tokenize.NEWLINE, "", (number, len(line)), (number, len(line)), line)
+            else:
+                token = tokenize.TokenInfo(tokenize.COMMENT, marker, (number, column),
+                                           (number, column + len(marker)), line)
+            for rule in rules:
+                rule(token)
+
+    def check_stream(self):
+        """Line and token rules in one pass over a file read chunk by chunk, for files over max_ast_size.
+
+        The tokenizer pulls lines through readline, which hands each line to the line rules on the
+        way, so memory holds one buffered chunk and the current token instead of the whole file.
+        Without an AST to validate the file, check_markers() cannot stand in for the pure python
+        tokenizer here, which costs this stage up to about a second per MiB before Python 3.12."""
+        line_rules = self.stage_rules("lines")
+        self.blank_lines_count = 0
+        number = 0
+        raw = open(self.file, "rb") if self.source is None else io.BytesIO(self.source)
+        try:
+            encoding = tokenize.detect_encoding(raw.readline)[0]
+        except SyntaxError as error:
+            print(f"{self.file}: {error}", file=sys.stderr)
+            encoding = "utf-8"
+        raw.seek(0)
+        with io.TextIOWrapper(raw, encoding, errors="replace") as stream:
+            def readline():
+                nonlocal number
+                text = stream.readline()
+                if text:
+                    number += 1
+                    line = LineInfo(number, text)
+                    for rule in line_rules:
+                        rule(line)
+                return text
+
+            if "tokens" in self.stages:
+                self.check_tokens(readline)
+            while readline():
+                pass
+        self.streamed_lines = number
 
     @staticmethod
     def sub_parentheses(original_string):
@@ -134,7 +458,7 @@ class CodeAnalyzer(object):
             try:
                 end_index = original_string.index(")")
             except ValueError:
-                print("SyntaxError: '(' was never closed")
+                print("SyntaxError: '(' was never closed", file=sys.stderr)
                 # so there can be something implemented
                 return None
             else:
@@ -142,161 +466,1428 @@ class CodeAnalyzer(object):
         else:
             return None
 
-    def check_camel_case(self):
-        for counter, line in enumerate(self.file_lines):
-            line = line.strip()
-            if line.startswith("class"):
-                line = line.removeprefix("class").lstrip()
-                if not line or line == ":":
-                    print("camel case empty")
-                    continue
-                if not search(CodeAnalyzer.template_camel, line):
-                    self.error_add(counter + 1, 8)
-                    continue
+    def get_analyzer(self):
+        """Walks the module tree once and keeps the visitor for every AST based check"""
+        if self.analyzer is None:
+            self.analyzer = Analyzer()
+            if self.tree is not None:
+                self.analyzer.visit(self.tree)
+        return self.analyzer
 
-    def check_spacing_after_name(self):
-        for counter, line in enumerate(self.file_lines):
-            line = line.lstrip()
-            if line.startswith("class") or line.startswith("def"):
-                start_index = line.find(" ")
-                if start_index != -1:
-                    outline = line[start_index:]
-                    indent_len = len(outline) - len(outline.lstrip())
-                    if indent_len > 1:
-                        self.error_add(counter + 1, 7)
-                """if search(r"^def  ", line) is not None or search(r"class  ", line) is not None:
-                    self.error_add(counter + 1, 7)"""
-
-    def check_snake_case(self):
-        for counter, line in enumerate(self.file_lines):
-            line = line.strip(" \n:")
-            if line.startswith("def"):
-                line = line.removeprefix("def").lstrip()
-                if not line or line == ":":
-                    print("snake case empty")
-                    continue
-                if not search(CodeAnalyzer.template_snake, line):
-                    self.error_add(counter + 1, 9)
-                    continue
+    @staticmethod
+    def is_mutable(node) -> bool:
+        """Literal or call that builds a new mutable object, e.g. [], {}, {1}, [x for x in y], list()"""
+        if isinstance(node, (ast.List, ast.Dict, ast.Set, ast.ListComp, ast.DictComp, ast.SetComp)):
+            return True
+        if isinstance(node, ast.Call):
+            func = node.func
+            name = func.id if isinstance(func, ast.Name) else getattr(func, "attr", None)
+            return name in CodeAnalyzer.mutable_calls
+        return False
 
-    def check_variable_snake(self):
-        for counter, line in enumerate(self.file_lines):
-            line = line.lstrip()
-            if line.startswith("def"):
-                line = line+"    pass"
-                try:
-                    tree = ast.parse(line)
-                except SyntaxError as error:
-                    print(f"error has occurred: {counter}", error)
-                else:
-                    body = tree.body[0]
-                    #print(body.name, [b.arg for b in body.args.args], [ast.dump(a) for a in  body.args.defaults])
-                    defaults_par = [a for a in body.args.defaults if isinstance(a, ast.List)]
-                    if defaults_par:
-                        self.error_add(counter + 1, 12)
-                    for var_names in body.args.args:
-                        if not search(CodeAnalyzer.template_snake, var_names.arg):
-                            self.error_add(counter + 1, 10)
-                            continue
-
-    def check_var_assert(self):
-        for counter, line in enumerate(self.file_lines):
-            line = line.lstrip()
-            try:
-                tree = ast.parse(line)
-            except SyntaxError as error:
-                pass
+    @staticmethod
+    def is_snake_case(name) -> bool:
+        """Only lowercase letters, digits and underscores; one linear scan in C"""
+        return bool(name) and not name.strip(CodeAnalyzer.snake_chars)
+
+    @staticmethod
+    def is_camel_case(name) -> bool:
+        """Words of one uppercase letter followed by lowercase letters or digits, e.g. CodeAnalyzer2.
+
+        A single left to right scan, so the time is linear in the identifier length whatever it holds."""
+        if not name or name[0] not in string.ascii_uppercase:
+            return False
+        word_length = 0
+        for char in name[1:]:
+            if char in CodeAnalyzer.camel_tail_chars:
+                word_length += 1
+            elif char in string.ascii_uppercase and word_length:
+                word_length = 0
             else:
-                if not tree.body:
-                    continue
-                body = tree.body[0]
-                if isinstance(body, ast.Assign):
-                    for names in [a.id for a in body.targets if isinstance(a, ast.Name)]:
-                        if not search(CodeAnalyzer.template_snake, names):
-                            self.error_add(counter + 1, 11)
-                            continue
+                return False
+        return word_length > 0
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1 << 16)
+    def classify(name) -> tuple:
+        """(is_snake_case, is_camel_case) of an identifier.
+
+        Memoized for the whole process since the same names (self, data, result...) recur in every file."""
+        return CodeAnalyzer.is_snake_case(name), CodeAnalyzer.is_camel_case(name)
+
+    def ast_class_name(self, analyzer):
+        for node in analyzer.classes:
+            if not CodeAnalyzer.classify(node.name)[1]:
+                self.error_add(node.lineno, 8, node.col_offset + 1)
+
+    @staticmethod
+    def arguments(node) -> list:
+        args = node.args
+        arguments = args.posonlyargs + args.args + args.kwonlyargs
+        return arguments + [arg for arg in (args.vararg, args.kwarg) if arg is not None]
+
+    def ast_function_name(self, analyzer):
+        for node in analyzer.functions:
+            if not CodeAnalyzer.classify(node.name)[0]:
+                self.error_add(node.lineno, 9, node.col_offset + 1)
+
+    def ast_argument_names(self, analyzer):
+        for node in analyzer.functions:
+            for argument in CodeAnalyzer.arguments(node):
+                if not CodeAnalyzer.classify(argument.arg)[0]:
+                    self.error_add(argument.lineno, 10, argument.col_offset + 1)
+
+    def ast_mutable_defaults(self, analyzer):
+        for node in analyzer.functions:
+            defaults = node.args.defaults + [value for value in node.args.kw_defaults if value is not None]
+            mutable = [value for value in defaults if CodeAnalyzer.is_mutable(value)]
+            if mutable:
+                self.error_add(mutable[0].lineno, 12, mutable[0].col_offset + 1)
+
+    def ast_variable_names(self, analyzer):
+        for line, column, name in analyzer.assignments:
+            if not CodeAnalyzer.classify(name)[0]:
+                self.error_add(line, 11, column + 1)
+
+    def check_ast(self):
+        analyzer = self.get_analyzer()
+        for rule in self.stage_rules("ast"):
+            rule(analyzer)
 
     def pep_checks_wrapper(self) -> None:
-        """Individually calling a function if actually faster than "for each cycle"""
-        self.check_lines_length()
-        self.check_indent()
-        self.check_semicolon()
-        self.check_inline_comment()
-        self.check_todo()
-        self.check_new_lines()
-        self.check_camel_case()
-        self.check_snake_case()
-        self.check_spacing_after_name()
-        self.check_variable_snake()
-        self.check_var_assert()
+        """Runs each stage at most once, and only if an enabled rule needs it"""
+        if self.streaming:
+            self.check_stream()
+            return
+        if "lines" in self.stages:
+            self.check_lines()
+        if "tokens" in self.stages:
+            self.check_tokens()
+        if "ast" in self.stages:
+            self.check_ast()
 
     def getter_filename(self):
         return self.file
 
+    @staticmethod
+    def print_errors(file, errors):
+        """errors is any iterable of (line, code, column) tuples"""
+        TextReporter(sys.stdout).write(file, errors)
+
     def __str__(self):
         self.errors.sort()
-        for error in self.errors:
-            print(f'{self.file}: Line {error[0]}: {CodeAnalyzer.error_codes[error[1]]}')
+        CodeAnalyzer.print_errors(self.file, self.errors)
         return ""
 
 
+class TextReporter(object):
+    """Writes diagnostics in the human readable "file: Line n: S00x message" format.
+
+    Reporters get the findings of a whole file at once and write them with a single call on a
+    buffered stream, instead of one print per line. fixed marks findings that went away (--watch)."""
+
+    batch_size = 4096
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def format(self, file, line, code, column, fixed) -> str:
+        state = "fixed " if fixed else ""
+        return f"{file}: Line {line}: {state}{CodeAnalyzer.error_codes[code]}\n"
+
+    def write(self, file, errors, fixed=False):
+        errors = iter(errors)
+        while True:
+            # one write per batch keeps a file with millions of findings from being formatted all at once
+            batch = [self.format(file, line, code, column, fixed)
+                     for line, code, column in itertools.islice(errors, TextReporter.batch_size)]
+            if not batch:
+                break
+            self.stream.write("".join(batch))
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+
+class JsonLinesReporter(TextReporter):
+    """One JSON object per diagnostic and line, e.g. for loading into dashboards"""
+
+    def format(self, file, line, code, column, fixed) -> str:
+        message = CodeAnalyzer.error_codes[code]
+        record = {"path": file, "line": line, "column": column, "code": message[:4], "message": message[5:]}
+        if fixed:
+            record["fixed"] = True
+        return json.dumps(record) + "\n"
+
+
+class SarifReporter(TextReporter):
+    """A single SARIF 2.1.0 log, streamed: results are written as files finish and closed by close()"""
+    schema = "https://json.schemastore.org/sarif-2.1.0.json"
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        rules = [{"id": rule.message[:4], "shortDescription": {"text": rule.message[5:]}}
+                 for _, rule in sorted(CodeAnalyzer.registry.items())]
+        driver = {"name": "code_analyzer", "version": CodeAnalyzer.version, "rules": rules}
+        header = json.dumps({"version": "2.1.0", "$schema": SarifReporter.schema,
+                             "runs": [{"tool": {"driver": driver}, "results": []}]})
+        self.stream.write(header[:header.rindex("[]") + 1])  # up to and including "results": [
+        self.footer = "]}]}\n"
+        self.separator = ""
+
+    def format(self, file, line, code, column, fixed) -> str:
+        message = CodeAnalyzer.error_codes[code]
+        region = {"startLine": line}
+        if column:
+            region["startColumn"] = column
+        result = {"ruleId": message[:4], "level": "warning", "message": {"text": message[5:]},
+                  "locations": [{"physicalLocation": {"artifactLocation": {"uri": file.replace(os.sep, "/")},
+                                                      "region": region}}]}
+        if fixed:
+            result["baselineState"] = "absent"
+        text = self.separator + json.dumps(result)
+        self.separator = ","
+        return text
+
+    def close(self):
+        self.stream.write(self.footer)
+        self.flush()
+
+
+class ResultCache(object):
+    """On-disk cache of per-file results, one small JSON entry per analysed file.
+
+    An entry is found by file path, analyzer version and rule set. It is a hit without opening the
+    file when size and mtime still match, and a hit without parsing when only the content hash does.
+    Entries are written atomically with os.replace, so concurrent runs never see a torn entry, and
+    evict() drops the least recently used entries once they grow past max_bytes. Only files named
+    like entries are ever evicted, so other files in a shared directory are left alone. A hit
+    refreshes the entry's mtime, which is what evict() goes by, at most once per refresh_interval."""
+    entry_name = re.compile(r"[0-9a-f]{40}\Z")
+    refresh_interval = 24 * 3600  # seconds
+    temp_prefix = ".code_analyzer-tmp"  # entries being written; evict() removes ones left by a killed run
+    state_name = ".code_analyzer-evicted"  # directory mtime and size limit at the end of the last evict()
+
+    def __init__(self, directory, rules, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.salt = f"{CodeAnalyzer.version}:{CodeAnalyzer.max_ast_size}:{','.join(map(str, sorted(rules)))}:"
+        self.salted = hashlib.sha1(self.salt.encode())
+        os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        # hash objects do not pickle; workers rebuild the salted prefix
+        return dict(self.__dict__, salted=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, salted=hashlib.sha1(state["salt"].encode()))
+
+    def entry_path(self, file):
+        key = self.salted.copy()
+        key.update(os.path.abspath(file).encode())
+        return os.path.join(self.directory, key.hexdigest())
+
+    @staticmethod
+    def digest(buffer) -> str:
+        return hashlib.blake2b(buffer, digest_size=16).hexdigest()
+
+    def get(self, file):
+        """Returns (errors, stamp, entry) where errors is not None only when size and mtime still match.
+
+        On a miss stamp is the file's current size and mtime, and entry is the stale entry, if any,
+        whose digest can still be compared once the file has been read."""
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None, None, None
+        stamp = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "digest": None}
+        entry_path = self.entry_path(file)
+        # a hit is all overhead, so the entry is read with bare descriptors rather than a file object
+        try:
+            fd = os.open(entry_path, os.O_RDONLY)
+        except OSError:
+            return None, stamp, None
+        try:
+            entry_stat = os.fstat(fd)
+            refresh = entry_stat.st_mtime < time.time() - ResultCache.refresh_interval
+            entry = json.loads(os.read(fd, entry_stat.st_size))
+        except (OSError, ValueError):
+            return None, stamp, None
+        finally:
+            os.close(fd)
+        if entry["size"] == stamp["size"] and entry["mtime"] == stamp["mtime"]:
+            if refresh:
+                try:
+                    os.utime(entry_path)
+                except OSError:
+                    pass
+            return Diagnostics(base64.b64decode(entry["errors"])), stamp, entry
+        return None, stamp, entry
+
+    def put(self, file, errors, stamp):
+        entry = dict(stamp, errors=base64.b64encode(errors.tobytes()).decode())
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=ResultCache.temp_prefix)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f, separators=(",", ":"))
+            os.replace(temp_path, self.entry_path(file))
+        except OSError as error:
+            print(f"cache write failed: {error}", file=sys.stderr)
+
+    def evict(self):
+        """Removes least recently used entries until the cache is back under max_bytes.
+
+        Entries are only added or replaced by renames, which change the directory's mtime, so the
+        scan is skipped when that mtime is the one recorded at the end of the previous evict()."""
+        state_path = os.path.join(self.directory, ResultCache.state_name)
+        try:
+            with open(state_path) as f:
+                state = f.read()
+            if state == f"{os.stat(self.directory).st_mtime_ns} {self.max_bytes}":
+                return
+        except OSError:
+            pass
+        entries = []
+        total = 0
+        abandoned = time.time() - 3600
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                is_temp = entry.name.startswith(ResultCache.temp_prefix)
+                if not is_temp and not ResultCache.entry_name.match(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if is_temp:
+                        if stat.st_mtime < abandoned:
+                            os.remove(entry.path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                if total <= self.max_bytes * 0.9:
+                    break
+        try:
+            # created before the directory mtime is taken and then rewritten in place, which keeps it
+            open(state_path, "a").close()
+            mtime = os.stat(self.directory).st_mtime_ns
+            with open(state_path, "w") as f:
+                f.write(f"{mtime} {self.max_bytes}")
+        except OSError:
+            pass
+
+
+class Baseline(object):
+    """Fingerprints of accepted findings; filter() drops the findings that are in the baseline.
+
+    A fingerprint is a 64 bit blake2b hash of the path relative to the directory of the baseline
+    file, the rule and the line content with its whitespace collapsed, so it survives lines moving
+    up or down and does not depend on the directory the analyzer runs from. A counter of identical
+    lines keeps the fourth copy of a baselined line from hiding behind the other three. The file is a
+    short header and the sorted fingerprints as little endian 64 bit integers, 8 bytes per finding."""
+    magic = b"CABASE1\n"
+
+    def __init__(self, path=None, write_path=None):
+        """path is the baseline to filter with, write_path the one save() will write"""
+        self.known = set()
+        self.recorded = array.array("Q")  # fingerprints of every finding passed to filter(), for write_path
+        self.new = 0  # findings reported as new, counted by FileFinder.report()
+        self.anchor = None if path is None else os.path.dirname(os.path.abspath(path))
+        self.write_anchor = None if write_path is None else os.path.dirname(os.path.abspath(write_path))
+        if path is not None:
+            with open(path, "rb") as f:
+                if f.read(len(Baseline.magic)) != Baseline.magic:
+                    raise ValueError(f"{path}: not a baseline file")
+                fingerprints = array.array("Q", f.read())
+            if sys.byteorder == "big":
+                fingerprints.byteswap()
+            self.known = set(fingerprints)
+
+    @staticmethod
+    def fingerprints(file, errors, anchor):
+        """(error, fingerprint) for each (line, code, column) of file, whose path is taken relative to anchor"""
+        lines = linecache.getlines(file)
+        linecache.cache.pop(file, None)  # large files are read once here, not kept around
+        path = os.path.relpath(os.path.abspath(file), anchor).replace(os.sep, "/")
+        seen = collections.Counter()
+        for error in errors:
+            text = " ".join(lines[error[0] - 1].split()) if error[0] <= len(lines) else ""
+            seen[error[1], text] += 1
+            key = f"{path}\0{error[1]}\0{text}\0{seen[error[1], text]}".encode()
+            yield error, int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+    def filter(self, file, errors) -> list:
+        if self.write_anchor is not None and self.write_anchor != self.anchor:
+            self.recorded.extend(fingerprint for _, fingerprint in
+                                 Baseline.fingerprints(file, errors, self.write_anchor))
+        if self.anchor is None:
+            return list(errors)
+        kept = []
+        for error, fingerprint in Baseline.fingerprints(file, errors, self.anchor):
+            if self.write_anchor == self.anchor:
+                self.recorded.append(fingerprint)
+            if fingerprint not in self.known:
+                kept.append(error)
+        return kept
+
+    def save(self, path):
+        fingerprints = array.array("Q", sorted(self.recorded))
+        if sys.byteorder == "big":
+            fingerprints.byteswap()
+        with open(path, "wb") as f:
+            f.write(Baseline.magic)
+            fingerprints.tofile(f)
+
+
+class ProfiledAnalyzer(CodeAnalyzer):
+    """CodeAnalyzer that records wall time and call count of file reading, parsing, each check_* stage
+    and, with rule_timing, each rule. Timing every rule call adds two perf_counter calls per line and rule."""
+
+    def __init__(self, file, rules=None, source=None, rule_timing=True):
+        self.times = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.rule_timing = rule_timing
+        start = perf_counter()
+        super().__init__(file, rules, source)
+        self.record("read", perf_counter() - start - self.times.get("parse", 0.0))
+
+    def record(self, name, seconds):
+        self.times[name] += seconds
+        self.calls[name] += 1
+
+    def timed(self, name, function):
+        def wrapper(*args):
+            start = perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.record(name, perf_counter() - start)
+
+        return wrapper
+
+    def parse(self, text):
+        self.timed("parse", super().parse)(text)
+
+    def stage_rules(self, stage) -> list:
+        if not self.rule_timing:
+            return super().stage_rules(stage)
+        return [self.timed(rule.message[:4], getattr(self, rule.method))
+                for code, rule in sorted(CodeAnalyzer.registry.items())
+                if rule.stage == stage and code in self.enabled]
+
+    def check_lines(self):
+        self.timed("check_lines", super().check_lines)()
+
+    def check_tokens(self, readline=None):
+        if readline is not None:
+            # called from inside check_stream, whose time already includes it
+            return super().check_tokens(readline)
+        self.timed("check_tokens", super().check_tokens)(readline)
+
+    def check_stream(self):
+        self.timed("check_stream", super().check_stream)()
+
+    def check_ast(self):
+        self.timed("check_ast", super().check_ast)()
+
+
+class Profiler(object):
+    """Collects the per-file statistics of ProfiledAnalyzer runs and prints the --profile summary.
+
+    Cache hits are counted on a line of their own, apart from the files and lines/s of analysed files."""
+
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.files = []  # (seconds, file)
+        self.lines = 0
+        self.cached = 0
+        self.cached_seconds = 0.0
+        self.start = perf_counter()
+
+    def add(self, file, stats):
+        if stats["cached"]:
+            self.cached += 1
+            self.cached_seconds += stats["seconds"]
+            return
+        self.files.append((stats["seconds"], file))
+        self.lines += stats["lines"]
+        for name, seconds in stats["times"].items():
+            self.times[name] += seconds
+        self.calls.update(stats["calls"])
+
+    def report(self, stream, top=10):
+        elapsed = perf_counter() - self.start
+        stream.write(f"profile: {len(self.files)} files, {self.lines} lines in {elapsed:.3f} s "
+                     f"({len(self.files) / elapsed:.1f} files/s, {self.lines / elapsed:.0f} lines/s)\n")
+        if self.cached:
+            stream.write(f"cached: {self.cached} files in {self.cached_seconds * 1000:.2f} ms\n")
+        stream.write(f"{'stage/rule':<14} {'calls':>12} {'total ms':>12} {'us/call':>12}\n")
+        for name, seconds in sorted(self.times.items(), key=lambda item: -item[1]):
+            calls = self.calls[name]
+            stream.write(f"{name:<14} {calls:>12} {seconds * 1000:>12.2f} {seconds * 1e6 / max(calls, 1):>12.2f}\n")
+        stream.write("slowest files:\n")
+        for seconds, file in heapq.nlargest(top, self.files):
+            stream.write(f"{seconds * 1000:>10.2f} ms  {file}\n")
+
+
+def warm_identifier_cache(names=CodeAnalyzer.common_identifiers):
+    """Fills the classify() cache of a fresh worker with common names"""
+    for name in names:
+        CodeAnalyzer.classify(name)
+
+
+def init_worker(max_ast_size):
+    """Process pool initializer: copies the main process settings and warms the identifier cache"""
+    CodeAnalyzer.max_ast_size = max_ast_size
+    warm_identifier_cache()
+
+
+def run_checks(file, cache, rules, analyzer_class, lookup=None, source=None):
+    """Returns (errors, analyzer); analyzer is None when the result came from the cache.
+
+    With a cache the file is read once, and the same buffer is hashed for the cache and analysed.
+    lookup and source are the cache.get() result and the raw content when prefetch() already has them."""
+    stamp = entry = None
+    if cache is not None:
+        errors, stamp, entry = cache.get(file) if lookup is None else lookup
+        if errors is not None:
+            return errors, None
+    if stamp is None:
+        analyzer = analyzer_class(file, rules, source)
+        analyzer.pep_checks_wrapper()
+        return analyzer.errors, analyzer
+    analyzer = None
+    with open_buffer(file) if source is None else contextlib.nullcontext(source) as buffer:
+        stamp["digest"] = ResultCache.digest(buffer)
+        if entry is not None and entry["size"] == stamp["size"] and entry["digest"] == stamp["digest"]:
+            errors = Diagnostics(base64.b64decode(entry["errors"]))
+        else:
+            analyzer = analyzer_class(file, rules, buffer)
+            analyzer.pep_checks_wrapper()
+            errors = analyzer.errors
+    cache.put(file, errors, stamp)
+    return errors, analyzer
+
+
+def analyse_file(file, cache=None, rules=None, profile=False, prefetched=(None, None)):
+    """Process pool worker: runs the enabled checks on one file and returns (file, Diagnostics).
+
+    With profile a third item carries the timings of a ProfiledAnalyzer as plain dicts.
+    prefetched is the (lookup, source) pair of prefetch(), if the file went through the read-ahead."""
+    if not profile:
+        return file, run_checks(file, cache, rules, CodeAnalyzer, *prefetched)[0]
+    start = perf_counter()
+    errors, analyzer = run_checks(file, cache, rules, ProfiledAnalyzer, *prefetched)
+    stats = {"seconds": perf_counter() - start, "lines": 0, "times": {}, "calls": {}, "cached": analyzer is None}
+    if analyzer is not None:
+        lines = analyzer.streamed_lines if analyzer.streaming else len(analyzer.file_lines)
+        stats.update(lines=lines, times=dict(analyzer.times), calls=dict(analyzer.calls))
+    return file, errors, stats
+
+
+def analyse_batch(files, cache=None, rules=None, profile=False) -> list:
+    """Process pool worker: analyse_file results of several files, returned in one round-trip"""
+    return [analyse_file(file, cache, rules, profile) for file in files]
+
+
+def prefetch(file, cache=None):
+    """Read-ahead worker: returns (lookup, source), the cache.get() result and the raw content of file.
+
+    source is None on a cache hit, for files large enough to be memory mapped and for unreadable
+    files, all of which run_checks() handles as if nothing had been prefetched."""
+    lookup = None if cache is None else cache.get(file)
+    if lookup is not None and lookup[0] is not None:
+        return lookup, None
+    try:
+        with open(file, "rb") as f:
+            if os.fstat(f.fileno()).st_size >= CodeAnalyzer.mmap_threshold:
+                return lookup, None
+            return lookup, f.read()
+    except OSError:
+        return lookup, None
+
+
+class PathFilter(object):
+    """Decides during discovery which directories are entered and which .py files are kept.
+
+    Patterns use .gitignore syntax: * and ? do not match /, ** matches across directories, a trailing
+    / matches directories only, and a pattern without any other / matches names at every depth while
+    one with a / is anchored at its base directory. exclude patterns and .gitignore lines prune whole
+    directories, which are then never scanned; include patterns, if any, select the files to keep.
+    Patterns given on the command line are relative to the analysed path, .gitignore lines to
+    their own directory; the .gitignore files above the path count up to the root of the work tree."""
+
+    def __init__(self, include=(), exclude=(), gitignore=True):
+        self.include = [PathFilter.compile(pattern) for pattern in include]
+        self.exclude = [PathFilter.compile(pattern) for pattern in exclude]
+        self.gitignore = gitignore
+
+    @staticmethod
+    def translate(pattern) -> str:
+        parts = []
+        index = 0
+        while index < len(pattern):
+            char = pattern[index]
+            if pattern.startswith("**/", index):
+                parts.append("(?:.*/)?")
+                index += 3
+                continue
+            if pattern.startswith("**", index):
+                parts.append(".*")
+                index += 2
+                continue
+            end = pattern.find("]", index + 2) if char == "[" else -1
+            if char == "*":
+                parts.append("[^/]*")
+            elif char == "?":
+                parts.append("[^/]")
+            elif end != -1:
+                chars = pattern[index + 1:end].replace("\\", "\\\\")
+                parts.append("[^" + chars[1:] + "]" if chars.startswith("!") else "[" + chars + "]")
+                index = end
+            else:
+                parts.append(re.escape(char))
+            index += 1
+        return "".join(parts)
+
+    @staticmethod
+    def compile(pattern) -> tuple:
+        """(regex, negated, directories only) of one pattern, the regex matching relative paths"""
+        negated = pattern.startswith("!")
+        if negated or pattern.startswith("\\"):
+            pattern = pattern[1:]
+        directories = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        regex = PathFilter.translate(pattern.lstrip("/"))
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        return re.compile(regex + r"\Z"), negated, directories
+
+    @staticmethod
+    def read_gitignore(directory) -> list:
+        try:
+            with open(os.path.join(directory, ".gitignore"), encoding="utf-8", errors="replace") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return []
+        return [PathFilter.compile(line.rstrip(" ")) for line in lines if line.strip() and not line.startswith("#")]
+
+    def parent_layers(self, directory) -> list:
+        """(base, rules) of the .gitignore files above directory, outermost first, within a work tree.
+        base is the length of the path prefix to strip to get paths relative to the file's directory."""
+        if not self.gitignore:
+            return []
+        layers = []
+        while not os.path.exists(os.path.join(directory, ".git")):
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return []  # not in a git work tree
+            directory = parent
+            rules = PathFilter.read_gitignore(directory)
+            if rules:
+                layers.append((len(os.path.join(directory, "")), rules))
+        return layers[::-1]
+
+    @staticmethod
+    def matches(rules, path, directory) -> bool:
+        """Whether path is ignored by rules, the last matching one winning, as in .gitignore files"""
+        ignored = False
+        for regex, negated, directories in rules:
+            if (directory or not directories) and regex.match(path):
+                ignored = not negated
+        return ignored
+
+    def ignored(self, layers, path, relative, directory) -> bool:
+        """path is absolute, relative is relative to the analysed path"""
+        if self.exclude and PathFilter.matches(self.exclude, relative, directory):
+            return True
+        ignored = False
+        for base, rules in layers:
+            for regex, negated, directories in rules:
+                if (directory or not directories) and regex.match(path, base):
+                    ignored = not negated
+        return ignored
+
+    def selects_walked(self, relative) -> bool:
+        """Include patterns of a file whose directories walk() has already checked"""
+        return not self.include or any(regex.match(relative) for regex, _, _ in self.include)
+
+    def selects(self, relative) -> bool:
+        """Include and exclude patterns only, for files found otherwise than by walking, e.g. --diff"""
+        parts = relative.replace(os.sep, "/").split("/")
+        relative = "/".join(parts)
+        for end in range(1, len(parts) + 1):
+            if self.exclude and PathFilter.matches(self.exclude, "/".join(parts[:end]), end < len(parts)):
+                return False
+        return self.selects_walked(relative)
+
+
 class FileFinder(object):
+    pruned_dirs = ("__pycache__",)
+    batch_bytes = 256 * 1024  # files are sent to the process pool in batches of about this many bytes
+    batch_files = 64  # and at most this many files
 
-    def __init__(self, path):
+    def __init__(self, path, cache=None, rules=None, reporter=None, profiler=None, dedupe=False, baseline=None,
+                 path_filter=None):
         self.path = path
         self.pats = path
-        self.exec = []
-        if os.path.isdir(path):
-            files = os.listdir(path)
-            files.sort()
-            for file in files:
-                if file.endswith(".py"):
-                    #print(os.path.join(path, file))
-                    self.exec.append(CodeAnalyzer(os.path.join(path, file)))
+        self.cache = cache
+        self.rules = rules
+        self.reporter = TextReporter(sys.stdout) if reporter is None else reporter
+        self.profiler = profiler
+        self.dedupe = dedupe
+        self.baseline = baseline
+        self.path_filter = PathFilter() if path_filter is None else path_filter
+        self.copies = {}  # with dedupe: file -> earlier file with the same content
+        self.order = collections.deque()  # with dedupe: files in discovery order, not reported yet
+        self.shared = {}  # with dedupe: Diagnostics of files that have copies
+        if not os.path.exists(path):
+            print("sorry your path is not gonna make it", file=sys.stderr)
+
+    @staticmethod
+    def pruned(name) -> bool:
+        """Directories that are never entered: hidden ones (.git, .venv, ...) and byte-code caches"""
+        return name.startswith(".") or name in FileFinder.pruned_dirs
+
+    def walk(self, path, absolute, relative, layers):
+        """Lazily yields .py files below path, depth first and sorted by name within each directory.
+
+        absolute and relative are path as an absolute path and relative to the analysed path, both with
+        / separators, for the path filter; layers are the .gitignore rules in effect in path."""
+        try:
+            with os.scandir(path) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as error:
+            print(f"cannot read directory: {error}", file=sys.stderr)
+            return
+        if self.path_filter.gitignore and any(entry.name == ".gitignore" for entry in entries):
+            rules = PathFilter.read_gitignore(path)
+            if rules:
+                layers = layers + [(len(absolute) + 1, rules)]
+        for entry in entries:
+            directory = entry.is_dir(follow_symlinks=False)
+            if directory and FileFinder.pruned(entry.name):
+                continue
+            if not directory and not (entry.name.endswith(".py") and entry.is_file()):
+                continue
+            entry_absolute = f"{absolute}/{entry.name}"
+            entry_relative = f"{relative}/{entry.name}" if relative else entry.name
+            if self.path_filter.ignored(layers, entry_absolute, entry_relative, directory):
+                continue
+            if directory:
+                yield from self.walk(entry.path, entry_absolute, entry_relative, layers)
+            elif self.path_filter.selects_walked(entry_relative):
+                yield entry.path
+
+    def files(self):
+        if os.path.isdir(self.path):
+            absolute = os.path.abspath(self.path)
+            layers = self.path_filter.parent_layers(absolute)
+            yield from self.walk(self.path, absolute.replace(os.sep, "/").rstrip("/"), "", layers)
         elif os.path.isfile(self.path):
-            self.exec.append(CodeAnalyzer(self.path))
+            yield self.path
+
+    def tasks(self):
+        """The files to analyse; with dedupe, every later copy of an already seen content is left out.
+
+        Only files sharing their size with another file are hashed. The copies are reported by
+        collect() with the diagnostics of the first file, at their place in discovery order."""
+        if not self.dedupe:
+            yield from self.files()
+            return
+        files = list(self.files())
+        by_size = collections.defaultdict(list)
+        for file in files:
+            try:
+                by_size[os.path.getsize(file)].append(file)
+            except OSError:
+                pass
+        for group in by_size.values():
+            if len(group) < 2:
+                continue
+            first = {}  # digest -> first file with that content
+            for file in group:
+                try:
+                    with open_buffer(file) as buffer:
+                        digest = ResultCache.digest(buffer)
+                except OSError:
+                    continue
+                original = first.setdefault(digest, file)
+                if original != file:
+                    self.copies[file] = original
+                    self.shared[original] = None
+        self.order.extend(files)
+        for file in files:
+            if file not in self.copies:
+                yield file
+
+    def execute_(self, jobs=1, read_ahead=0):
+        if jobs > 1:
+            self.execute_parallel(jobs)
+        elif read_ahead > 0:
+            self.execute_read_ahead(read_ahead)
         else:
-            dir_content = os.listdir(self.path)
-            print(dir_content)
-            print("sorry your path is not gonna make it")
+            for file in self.tasks():
+                self.collect(analyse_file(file, self.cache, self.rules, self.profiler is not None))
+        self.report_copies()
 
-    def execute_(self):
-        for file in self.exec:
-            # print(f"file: {file.getter_filename()}")
-            file.pep_checks_wrapper()
-            print(file, end="")
+    def collect(self, result):
+        """Takes one analyse_file result, in discovery order: feeds the profiler, if any, and reports
+        the findings, after those of the copies discovered before the file"""
+        file, errors = result[0], result[1]
+        if self.profiler is not None:
+            self.profiler.add(file, result[2])
+        if self.dedupe:
+            self.report_copies()
+            self.order.popleft()
+            if file in self.shared:
+                self.shared[file] = errors
+        self.report(file, errors)
 
-    def execute_time(self):
-        for file in self.exec:
-            # print(f"file: {file.getter_filename()}")
-            file.pep_checks_wrapper()
-            #print(file, end="")
+    def report_copies(self):
+        """Reports the copies at the head of the discovery order, whose originals came before them"""
+        while self.order and self.order[0] in self.copies:
+            file = self.order.popleft()
+            self.report(file, self.shared[self.copies[file]])
 
+    def report(self, file, errors):
+        errors.sort()
+        if self.baseline is not None:
+            # fingerprints count identical lines, so they are taken over all the findings of the file
+            errors = self.shown(file, self.baseline.filter(file, errors) if len(errors) else [])
+            self.baseline.new += len(errors)
+        else:
+            errors = self.shown(file, errors)
+        self.reporter.write(file, errors)
 
-def timer(func):
-    def wrapper(args_for_function):
-        start = time.time()
-        for i in range(10000):
-            func(args_for_function)
-        end = time.time()
-        print('func takes', (end - start)/10000, 'seconds')
+    def shown(self, file, errors):
+        """The findings of file to report, all of them by default"""
+        return errors
 
-    return wrapper
+    def execute_read_ahead(self, readers):
+        """Analyses files in this process while a thread pool stats and reads the next ones.
 
+        File reads release the GIL, so on slow (e.g. network mounted) storage waiting for contents
+        overlaps analysis instead of adding to it. At most readers * 4 files are read ahead, which
+        bounds memory; results are reported in discovery order."""
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(readers) as pool:
+            for file in self.tasks():
+                pending.append((file, pool.submit(prefetch, file, self.cache)))
+                if len(pending) >= readers * 4:
+                    self.analyse_prefetched(*pending.popleft())
+            while pending:
+                self.analyse_prefetched(*pending.popleft())
 
-@timer
-def func1(arg):
-    new = FileFinder(arg)
-    new.execute_time()
-    del new
+    def analyse_prefetched(self, file, future):
+        self.collect(analyse_file(file, self.cache, self.rules, self.profiler is not None, future.result()))
 
-if __name__ == "__main__":
-    #print(f"Arguments count: {len(sys.argv)}")
-    for i, arg in enumerate(sys.argv):
-        if i > 0:
-            #print(f"i = {i}: _{arg}_")
-            #func1(arg)
-            new = FileFinder(arg)
-            new.execute_()
+    def schedule(self) -> list:
+        """Splits the files into batches of (discovery index, file) for the process pool, longest first.
+
+        Files are ordered by descending size, so a huge generated module starts first instead of
+        finishing last (longest processing time first), and small files are grouped until a batch
+        holds batch_bytes or batch_files of them, so one round-trip carries many files and their results."""
+        sized = []
+        for index, file in enumerate(self.tasks()):
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                size = 0
+            sized.append((-size, index, file))
+        sized.sort()
+        batches = []
+        batch = []
+        batch_size = 0
+        for size, index, file in sized:
+            if -size >= FileFinder.batch_bytes:
+                batches.append([(index, file)])
+                continue
+            batch.append((index, file))
+            batch_size -= size
+            if batch_size >= FileFinder.batch_bytes or len(batch) >= FileFinder.batch_files:
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def execute_parallel(self, jobs):
+        """Analyses files in a process pool, in schedule() order, printing results in discovery order.
+
+        Results that finish early wait, as compact Diagnostics, until every file discovered before
+        them has been reported."""
+        profile = self.profiler is not None
+        done = {}  # discovery index -> analyse_file result
+        next_index = 0
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker,
+                                                    initargs=(CodeAnalyzer.max_ast_size,)) as pool:
+            futures = {}
+            for batch in self.schedule():
+                files = [file for _, file in batch]
+                futures[pool.submit(analyse_batch, files, self.cache, self.rules, profile)] = batch
+            for future in concurrent.futures.as_completed(futures):
+                done.update(zip((index for index, _ in futures.pop(future)), future.result()))
+                while next_index in done:
+                    self.collect(done.pop(next_index))
+                    next_index += 1
+
+
+class DiffFinder(FileFinder):
+    """Analyses only the python files changed in a git revision range and reports only touched lines.
+
+    The revision is passed to `git diff` as is: "HEAD" compares the working tree with the last commit,
+    "main..feature" two commits. Files are always read from the working tree."""
+    hunk_header = re.compile(r"^@@ -\S+ \+(\d+)(?:,(\d+))? @@")
+
+    def __init__(self, revision, path=".", cache=None, rules=None, reporter=None, profiler=None, dedupe=False,
+                 baseline=None, path_filter=None):
+        super().__init__(path, cache, rules, reporter, profiler, dedupe, baseline, path_filter)
+        self.revision = revision
+        self.changes = {}  # file -> set of touched line numbers in the working tree version
+        # git runs in the directory of a single file argument, e.g. from a pre-commit hook
+        self.directory = path if os.path.isdir(path) else os.path.dirname(path) or "."
+        try:
+            root = DiffFinder.git(self.directory, "rev-parse", "--show-toplevel").strip()
+            # fixed prefixes and unquoted non-ASCII names whatever the user's diff configuration is
+            diff = DiffFinder.git(self.directory, "-c", "core.quotePath=false", "diff", "--unified=0", "--no-color",
+                                  "--no-ext-diff", "--src-prefix=a/", "--dst-prefix=b/", "--diff-filter=AMR",
+                                  revision, "--", "*.py")
+        except subprocess.CalledProcessError as error:
+            raise ValueError(f"git diff failed: {error.stderr.strip() or error}") from error
+        except OSError as error:
+            raise ValueError(f"git diff failed: {error}") from error
+        self.parse_diff(root, diff)
+        if self.directory != path:
+            lines = self.changes.get(os.path.join(self.directory, os.path.basename(path)))
+            self.changes = {} if lines is None else {path: lines}
+
+    @staticmethod
+    def git(path, *args) -> str:
+        return subprocess.run(["git", "-C", path, *args], capture_output=True, text=True, check=True).stdout
+
+    @staticmethod
+    def unquote(name) -> str:
+        """Name of a +++ line: git ends names holding a space with a tab, and quotes names holding
+        quotes, backslashes or control characters C style, with octal escapes for their raw bytes"""
+        name = name.rstrip("\t")
+        if not (len(name) > 1 and name[0] == name[-1] == '"'):
+            return name
+        raw = bytearray()
+        escapes = {"a": 7, "b": 8, "t": 9, "n": 10, "v": 11, "f": 12, "r": 13, '"': 34, "\\": 92}
+        index = 1
+        while index < len(name) - 1:
+            char = name[index]
+            if char != "\\":
+                raw += char.encode()
+                index += 1
+            elif name[index + 1] in escapes:
+                raw.append(escapes[name[index + 1]])
+                index += 2
+            else:
+                raw.append(int(name[index + 1:index + 4], 8))
+                index += 4
+        return raw.decode("utf-8", "surrogateescape")
+
+    def parse_diff(self, root, diff):
+        lines = None
+        for row in diff.splitlines():
+            if row.startswith("+++ "):
+                name = DiffFinder.unquote(row[4:])
+                if name == "/dev/null":
+                    lines = None
+                else:
+                    file = os.path.relpath(os.path.join(root, name[len("b/"):]), self.directory)
+                    lines = self.changes.setdefault(os.path.join(self.directory, file), set())
+            elif row.startswith("@@") and lines is not None:
+                match = DiffFinder.hunk_header.match(row)
+                if match is None:
+                    continue
+                start = int(match.group(1))
+                count = 1 if match.group(2) is None else int(match.group(2))
+                if count:
+                    lines.update(range(start, start + count))
+                else:
+                    # pure deletion after line start: the lines around the gap are what changed
+                    lines.update((start, start + 1))
+
+    def files(self):
+        for file in sorted(self.changes):
+            if os.path.isfile(file) and (file == self.path or
+                                         self.path_filter.selects(os.path.relpath(file, self.directory))):
+                yield file
+
+    def touched(self, file, line, code) -> bool:
+        lines = self.changes[file]
+        if line in lines:
+            return True
+        if code == 6:
+            # S006 belongs to the line after the blank ones, editing any of them counts as touching it
+            previous = line - 1
+            while previous > 0 and not linecache.getline(file, previous).strip():
+                if previous in lines:
+                    return True
+                previous -= 1
+        return False
+
+    def shown(self, file, errors):
+        return [error for error in errors if self.touched(file, error[0], error[1])]
+
+
+class Watcher(FileFinder):
+    """Keeps every file's analyzer (lines, AST and diagnostics) in memory between polls.
+
+    Only files whose size or mtime changed are analysed again, and only diagnostics that appeared
+    or disappeared since the previous poll are printed."""
+
+    def __init__(self, path, rules=None, reporter=None, path_filter=None):
+        super().__init__(path, rules=rules, reporter=reporter, path_filter=path_filter)
+        self.state = {}  # file -> ((size, mtime_ns), CodeAnalyzer)
+
+    def poll(self):
+        seen = set()
+        for file in self.files():
+            seen.add(file)
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            previous = self.state.get(file)
+            if previous is not None and previous[0] == stamp:
+                continue
+            analyzer = CodeAnalyzer(file, self.rules)
+            analyzer.pep_checks_wrapper()
+            self.state[file] = (stamp, analyzer)
+            before = set() if previous is None else set(previous[1].errors.keys)
+            after = set(analyzer.errors.keys)
+            self.reporter.write(file, map(Diagnostics.unpack, sorted(after - before)))
+            self.reporter.write(file, map(Diagnostics.unpack, sorted(before - after)), fixed=True)
+        for file in sorted(self.state.keys() - seen):
+            # a deleted file has no findings left
+            self.reporter.write(file, map(Diagnostics.unpack, sorted(self.state[file][1].errors.keys)), fixed=True)
+            del self.state[file]
+
+
+class ImportIndex(object):
+    """Project wide import graph built with Analyzer, persisted as JSON and updated incrementally.
+
+    Every file entry keeps size, mtime and the module names its imports may refer to, so update()
+    parses only new and modified files, in a process pool with jobs > 1. Names are resolved against
+    the project's own modules when the graph is built, so files added later resolve without a rescan."""
+    version = 1
+    parse_rules = tuple(code for code, rule in CodeAnalyzer.registry.items() if rule.stage == "ast")
+
+    def __init__(self, root, index_path=None):
+        self.root = root
+        self.index_path = index_path or ImportIndex.default_path(root)
+        self.entries = {}  # path relative to root -> {"size", "mtime", "imports"}
+        self.modules = {}  # module name -> path relative to root
+        self.importers_of = {}  # module name -> set of relative paths importing it
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+            if data.get("version") == ImportIndex.version:
+                self.entries = data["files"]
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def default_path(root) -> str:
+        """Per-project file in the user's cache directory, so the project tree itself is left untouched,
+        e.g. ~/.cache/code_analyzer/imports-<hash of the absolute root>.json"""
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        key = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+        return os.path.join(cache_home, "code_analyzer", f"imports-{key}.json")
+
+    @staticmethod
+    def module_name(relative) -> str:
+        """Dotted module name of a path relative to the root, e.g. pkg/sub/mod.py -> pkg.sub.mod"""
+        parts = relative[:-len(".py")].split(os.sep)
+        if parts[-1] == "__init__":
+            parts.pop()
+        return ".".join(parts)
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": ImportIndex.version, "files": self.entries}, f, separators=(",", ":"))
+            os.replace(temp_path, self.index_path)
+        except OSError as error:
+            print(f"import index write failed: {error}", file=sys.stderr)
+
+    def update(self, jobs=1) -> int:
+        """Parses new and modified files, forgets deleted ones and rebuilds the graph; returns files parsed"""
+        stale = []
+        seen = set()
+        for file in FileFinder(self.root).files():
+            relative = os.path.relpath(file, self.root)
+            seen.add(relative)
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            entry = self.entries.get(relative)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+                stale.append((file, relative, stat))
+        removed = self.entries.keys() - seen
+        for relative in removed:
+            del self.entries[relative]
+        files = [file for file, _, _ in stale]
+        modules = [ImportIndex.module_name(relative) for _, relative, _ in stale]
+        packages = [os.path.basename(relative) == "__init__.py" for _, relative, _ in stale]
+        if jobs > 1 and len(stale) > 1:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                results = list(pool.map(scan_imports, files, modules, packages, chunksize=32))
+        else:
+            results = list(map(scan_imports, files, modules, packages))
+        for (_, relative, stat), imports in zip(stale, results):
+            self.entries[relative] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "imports": imports}
+        if stale or removed:
+            self.save()
+        self.build()
+        return len(stale)
+
+    def build(self):
+        self.modules = {ImportIndex.module_name(relative): relative for relative in self.entries}
+        self.importers_of = collections.defaultdict(set)
+        for relative, entry in self.entries.items():
+            for name in entry["imports"]:
+                if name in self.modules:
+                    self.importers_of[name].add(relative)
+
+    def importers(self, module) -> list:
+        """Files importing module directly"""
+        return [os.path.join(self.root, relative) for relative in sorted(self.importers_of.get(module, ()))]
+
+    def affected(self, files) -> list:
+        """files plus every file importing one of them, directly or transitively"""
+        affected = {os.path.relpath(file, self.root) for file in files}
+        queue = collections.deque(ImportIndex.module_name(relative) for relative in affected)
+        while queue:
+            for relative in self.importers_of.get(queue.popleft(), ()):
+                if relative not in affected:
+                    affected.add(relative)
+                    queue.append(ImportIndex.module_name(relative))
+        return [os.path.join(self.root, relative) for relative in sorted(affected)]
+
+
+def with_parents(name) -> list:
+    """a.b.c -> [a, a.b, a.b.c], since importing a submodule also imports its packages"""
+    parts = name.split(".")
+    return [".".join(parts[:end]) for end in range(1, len(parts) + 1)]
+
+
+def scan_imports(file, module, is_package) -> list:
+    """Process pool worker for ImportIndex: module names the imports of file may refer to.
+
+    Relative imports are resolved against the package of module; "from a import b" yields a and a.b
+    since b may be a submodule, whichever of them exists in the project is kept when resolving."""
+    analyzer = CodeAnalyzer(file, ImportIndex.parse_rules).get_analyzer()
+    package = module if is_package else module.rpartition(".")[0]
+    names = set()
+    for name in analyzer.imports:
+        names.update(with_parents(name))
+    for base, level, aliases in analyzer.imports_from:
+        if level:
+            parts = package.split(".") if package else []
+            if level - 1 > len(parts):
+                continue
+            parts = parts[:len(parts) - (level - 1)]
+            base = ".".join(parts + [base] if base else parts)
+        if base:
+            names.update(with_parents(base))
+        names.update(f"{base}.{alias}" if base else alias for alias in aliases if alias != "*")
+    return sorted(names)
+
+
+class AnalysisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return  # a liveness probe, or a client that gave up before sending anything
+        stream = codecs.getwriter("utf-8")(self.wfile)
+        try:
+            try:
+                self.server.respond(json.loads(line), stream)
+            except (ValueError, KeyError, TypeError, AttributeError) as error:
+                stream.write(f"error: bad request: {error!r}\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client went away, e.g. an editor dropping a stale request
+
+
+class AnalysisServer(socketserver.UnixStreamServer):
+    """Daemon behind --serve: analyses files and unsaved editor buffers sent over a Unix socket.
+
+    A request is one JSON line, e.g. {"cwd": "/src", "paths": ["pkg"], "select": "S001,S003",
+    "format": "jsonl", "buffers": [{"path": "pkg/mod.py", "source": "..."}]}, answered by the report,
+    after which the connection is closed. {"shutdown": true} stops the server. Requests are served one
+    at a time. Diagnostics of unchanged files and of recently seen buffers stay in memory along with
+    the identifier cache, so a repeated request costs a stat per file instead of a cold scan.
+    Missing paths and files that cannot be read are listed after the complete report, one
+    "error: path: reason" line each."""
+    max_buffers = 1024
+
+    def __init__(self, socket_path):
+        umask = os.umask(0o177)  # the socket is created with mode 0600, with no window for others to connect
+        try:
+            super().__init__(socket_path, AnalysisHandler)
+        finally:
+            os.umask(umask)
+        self.socket_path = socket_path
+        self.running = True
+        self.files = {}  # (file, rules) -> ((size, mtime_ns), Diagnostics)
+        self.buffers = collections.OrderedDict()  # (digest, rules) -> Diagnostics, least recently used first
+        warm_identifier_cache()
+
+    def respond(self, request, stream):
+        if request.get("shutdown"):
+            self.running = False
+            return
+        rules = parse_rules(request.get("select"), request.get("ignore"))
+        reporter = reporters[request.get("format", "text")](stream)
+        cwd = request.get("cwd", ".")
+        for buffer in request.get("buffers", ()):
+            reporter.write(buffer["path"], self.analyse_buffer(os.path.join(cwd, buffer["path"]),
+                                                               buffer["source"].encode(), rules))
+        failed = []
+        for path in request.get("paths", ()):
+            if not os.path.exists(os.path.join(cwd, path)):
+                failed.append(f"error: {path}: No such file or directory\n")
+                continue
+            for file in FileFinder(os.path.join(cwd, path)).files():
+                name = file if os.path.isabs(path) else os.path.relpath(file, cwd)
+                try:
+                    errors = self.analyse_file(file, rules)
+                except OSError as error:
+                    failed.append(f"error: {name}: {error.strerror or error}\n")
+                    continue
+                reporter.write(name, errors)
+        reporter.close()
+        stream.write("".join(failed))
+
+    def analyse_file(self, file, rules) -> Diagnostics:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return Diagnostics()
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        known = self.files.get((file, rules))
+        if known is not None and known[0] == stamp:
+            return known[1]
+        errors = run_checks(file, None, rules, CodeAnalyzer)[0]
+        errors.sort()
+        self.files[file, rules] = (stamp, errors)
+        return errors
+
+    def analyse_buffer(self, file, source, rules) -> Diagnostics:
+        """Diagnostics only depend on the content, so buffers are remembered by digest, not by path"""
+        key = (ResultCache.digest(source), rules)
+        errors = self.buffers.get(key)
+        if errors is not None:
+            self.buffers.move_to_end(key)
+            return errors
+        analyzer = CodeAnalyzer(file, rules, source)
+        analyzer.pep_checks_wrapper()
+        errors = analyzer.errors
+        errors.sort()
+        self.buffers[key] = errors
+        if len(self.buffers) > AnalysisServer.max_buffers:
+            self.buffers.popitem(last=False)
+        return errors
+
+
+reporters = {"text": TextReporter, "jsonl": JsonLinesReporter, "sarif": SarifReporter}
+
+
+def parse_rules(select=None, ignore=None) -> frozenset:
+    """Enabled rule codes from comma separated --select and --ignore lists; ValueError for unknown codes"""
+    rules = set(CodeAnalyzer.registry)
+    if select:
+        rules = {Rule.parse_code(name.strip()) for name in select.split(",") if name.strip()}
+    if ignore:
+        rules -= {Rule.parse_code(name.strip()) for name in ignore.split(",") if name.strip()}
+    return frozenset(rules)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PEP8 style checks for python files")
+    parser.add_argument("paths", nargs="*", help="files or directories to analyse")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--cache-dir", help="directory for cached results of unchanged files")
+    parser.add_argument("--cache-size", type=int, default=64, help="cache size limit in MiB")
+    parser.add_argument("--diff", metavar="REVISION",
+                        help="only analyse files changed in this git revision range, reporting touched lines")
+    parser.add_argument("--watch", action="store_true", help="keep running and report changed diagnostics")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between --watch polls")
+    parser.add_argument("--select", help="comma separated rule codes to run, e.g. S001,S003 (default: all)")
+    parser.add_argument("--ignore", help="comma separated rule codes to skip")
+    parser.add_argument("--format", choices=sorted(reporters), default="text", help="output format")
+    parser.add_argument("-o", "--output", help="write the report to this file instead of stdout")
+    parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                        help="only analyse files matching this .gitignore style pattern, may be repeated")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="skip files and directories matching this .gitignore style pattern, may be repeated")
+    parser.add_argument("--no-gitignore", action="store_true", help="do not skip paths ignored by .gitignore files")
+    parser.add_argument("--max-ast-size", type=float, default=64,
+                        help="files over this many MiB are streamed through the line and token rules only; "
+                             "their token rules always use the tokenizer, which is slow before Python 3.12")
+    parser.add_argument("--read-ahead", type=int, default=0, metavar="READERS",
+                        help="without -j, read files in this many threads ahead of the analysis, "
+                             "for slow or network mounted storage")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="analyse files with identical content once and report the result under every path")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="only report findings missing from this baseline, exit with 1 if there are any; "
+                             "paths in a baseline are relative to the directory of the baseline file")
+    parser.add_argument("--write-baseline", metavar="FILE",
+                        help="record the fingerprints of all findings in FILE, with paths relative to its directory")
+    parser.add_argument("--profile", action="store_true",
+                        help="print time and call counts per stage and rule, throughput and the slowest files")
+    parser.add_argument("--import-root", default=".", help="project root for --importers and --affected")
+    parser.add_argument("--import-index",
+                        help="import graph file (default: one per root in $XDG_CACHE_HOME/code_analyzer, "
+                             "~/.cache/code_analyzer without it)")
+    parser.add_argument("--importers", metavar="MODULE", help="print the files importing MODULE and exit")
+    parser.add_argument("--affected", action="store_true",
+                        help="print the given files and every file importing them, transitively, and exit")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as a server answering analyzer_client.py requests on a Unix socket")
+    parser.add_argument("--socket", default=analyzer_client.default_socket(), help="socket path for --serve")
+    args = parser.parse_args(argv)
+    if args.serve:
+        CodeAnalyzer.max_ast_size = int(args.max_ast_size * 1024 * 1024)
+        return serve(args.socket)
+    if args.importers or args.affected:
+        index = ImportIndex(args.import_root, args.import_index)
+        index.update(args.jobs)
+        files = index.importers(args.importers) if args.importers else index.affected(args.paths)
+        for file in files:
+            print(file)
+        return
+    if not args.paths:
+        parser.error("the following arguments are required: paths")
+    if not args.diff:  # a --diff path may name files the revision range deleted
+        missing = [path for path in args.paths if not os.path.exists(path)]
+        if missing:
+            parser.error(f"no such file or directory: {', '.join(missing)}")
+    try:
+        rules = parse_rules(args.select, args.ignore)
+    except ValueError as error:
+        parser.error(str(error))
+    baseline = None
+    if args.baseline or args.write_baseline:
+        try:
+            baseline = Baseline(args.baseline, args.write_baseline)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+    path_filter = PathFilter(args.include, args.exclude, not args.no_gitignore)
+    stream = sys.stdout if args.output is None else open(args.output, "w", buffering=1024 * 1024)
+    reporter = reporters[args.format](stream)
+    CodeAnalyzer.max_ast_size = int(args.max_ast_size * 1024 * 1024)
+    profiler = Profiler() if args.profile else None
+    try:
+        if args.watch:
+            watch(args.paths, rules, reporter, args.interval, path_filter)
+            return
+        cache = None
+        if args.cache_dir:
+            cache = ResultCache(args.cache_dir, rules, args.cache_size * 1024 * 1024)
+        for path in args.paths:
+            if args.diff:
+                try:
+                    new = DiffFinder(args.diff, path, cache, rules, reporter, profiler, args.dedupe, baseline,
+                                     path_filter)
+                except ValueError as error:
+                    parser.error(str(error))
+            else:
+                new = FileFinder(path, cache, rules, reporter, profiler, args.dedupe, baseline, path_filter)
+            new.execute_(args.jobs, args.read_ahead)
             del new
+        if cache is not None:
+            cache.evict()
+        if args.write_baseline:
+            baseline.save(args.write_baseline)
+        if profiler is not None:
+            reporter.flush()
+            profiler.report(sys.stderr)
+    finally:
+        reporter.close()
+        if stream is not sys.stdout:
+            stream.close()
+    if args.baseline and baseline.new:
+        return 1
+
 
+def private_directory(directory):
+    """Creates directory with mode 0700, or checks that an existing one is a directory only we can use"""
+    try:
+        os.mkdir(directory, 0o700)
+        return
+    except FileExistsError:
+        pass
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise OSError(f"{directory}: not a private directory of this user")
+
+
+def serve(socket_path) -> int:
+    try:
+        if socket_path == analyzer_client.default_socket() and not os.environ.get("XDG_RUNTIME_DIR"):
+            private_directory(os.path.dirname(socket_path))
+        if os.path.lexists(socket_path):
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise OSError(f"{socket_path}: exists and is not a socket")
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(socket_path)
+                except OSError:
+                    os.remove(socket_path)  # left behind by a server that did not exit cleanly
+                else:
+                    raise OSError(f"{socket_path}: a server is already listening")
+        server = AnalysisServer(socket_path)
+    except OSError as error:
+        print(f"cannot serve: {error}", file=sys.stderr)
+        return 1
+    try:
+        while server.running:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+    return 0
+
+
+def watch(paths, rules, reporter, interval, path_filter=None):
+    watchers = [Watcher(path, rules, reporter, path_filter) for path in paths]
+    try:
+        while True:
+            for watcher in watchers:
+                watcher.poll()
+            reporter.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())